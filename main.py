@@ -1,19 +1,36 @@
+import concurrent.futures
 import fractions
+import functools
 import math
-import random
+import multiprocessing
+import os
+import secrets
 import time
-from typing import Callable, Optional
+from typing import Callable, Iterator, Optional, Sequence
 
 import cirq
+import qsimcirq
 import sympy
+from sympy.ntheory import n_order
 
-from module_exp import ModularExp
+from module_exp import ModularExp, ModularMul
+
+# Длина n в битах, начиная с которой classical_fast_path в find_factor не применяется.
+QUANTUM_THRESHOLD = 20
+
+# Количество последних схем вычисления порядка, хранимых в кэше. x выбирается
+# случайно, поэтому большой кэш почти не дает попаданий, а только держит схемы в памяти.
+_CIRCUIT_CACHE_SIZE = 8
+
+# Проверка простоты кэшируется между вызовами find_factor.
+_is_prime = functools.lru_cache(maxsize=None)(sympy.isprime)
 
 
 def naive_order_finder(x: int, n: int) -> Optional[int]:
     """Нахождение наименьшего числа r, для которого x^r mod n == 1ю
 
-    Метод: "в тупую" через последовательный перебор
+    Метод: классический, через sympy.ntheory.n_order, который перебирает
+    делители функции Кармайкла λ(n) (порядок x всегда делит λ(n)).
 
     Арг.:
         x: число для, которого вычисляется порядок. Должно быть >1 и <n,
@@ -24,14 +41,29 @@ def naive_order_finder(x: int, n: int) -> Optional[int]:
     """
     if x < 2 or n <= x or math.gcd(x, n) > 1:
         raise ValueError(f'Invalid x={x} for modulus n={n}.')
-    r, y = 1, x
-    while y != 1:
-        y = (x * y) % n
-        r += 1
-    return r
+    return int(n_order(x, n))
+
+
+def make_qsim_simulator(circuit_memoization_size: int = 0) -> qsimcirq.QSimSimulator:
+    """Возвращает симулятор qsim (C++ с векторизацией AVX), использующий все ядра процессора.
+
+    ModularExp раскладывается в умножения на L+1 кубитах, а qsim принимает гейты
+    не более чем на 6 кубитах, поэтому симулятор подходит для n < 32.
+
+    Арг.:
+        circuit_memoization_size: количество последних схем, трансляция которых
+            в представление qsim сохраняется между запусками.
+    """
+    options = qsimcirq.QSimOptions(cpu_threads=os.cpu_count() or 1)
+    return qsimcirq.QSimSimulator(qsim_options=options, circuit_memoization_size=circuit_memoization_size)
 
 
-def quantum_order_finder(x: int, n: int) -> Optional[int]:
+def quantum_order_finder(
+        x: int,
+        n: int,
+        simulator: Optional[cirq.Sampler] = None,
+        semi_classical: bool = False
+) -> Optional[int]:
     """Нахождение наименьшего числа r, для которого x^r mod n == 1
 
     Метод: через квантовый алгоритм Шора
@@ -39,6 +71,11 @@ def quantum_order_finder(x: int, n: int) -> Optional[int]:
     Арг.:
         x: число для, которого вычисляется порядок. Должно быть >1 и <n,
         n: модуль мультипликативной группы.
+        simulator: симулятор для дискретизации схемы. Переиспользование одного
+            симулятора между попытками позволяет не повторять подготовку схемы.
+        semi_classical: использовать схему с полуклассическим обратным QFT
+            (L+1 кубит). Требует симулятор с поддержкой промежуточных измерений
+            и классического управления, например cirq.Simulator.
 
     Возвращает:
         Наименьшее положительное число r, для которого x^r mod n == 1.
@@ -47,17 +84,43 @@ def quantum_order_finder(x: int, n: int) -> Optional[int]:
     if x < 2 or n <= x or math.gcd(x, n) > 1:
         raise ValueError(f'Invalid x={x} for modulus n={n}.')
 
-    # Создание схемы вычисления порядка.
-    circuit = make_order_finding_circuit(x, n)
+    # Создание схемы вычисления порядка (схема кэшируется по (x, n)).
+    if semi_classical:
+        circuit = make_semi_classical_order_finding_circuit(x, n)
+    else:
+        circuit = make_order_finding_circuit(x, n)
 
     # Дискретизация схемы вычисления порядка.
-    measurement = cirq.sample(circuit)
+    if simulator is None:
+        simulator = cirq.Simulator()
+    measurement = simulator.run(circuit, repetitions=1)
 
     # Результат вычисления выходного значения.
     return process_measurement(measurement, x, n)
 
 
-def make_order_finding_circuit(x: int, n: int) -> cirq.Circuit:
+def approximate_inverse_qft(qubits: Sequence[cirq.Qid], depth: int) -> Iterator[cirq.Operation]:
+    """Обратное квантовое преобразование Фурье с отброшенными малыми поворотами (QFT Копперсмита).
+
+    Совпадает с cirq.qft(*qubits, inverse=True), но из управляемых поворотов фазы
+    на угол π/2^k оставлены только повороты с k <= depth. Остальные вносят
+    в результат ошибку порядка 1/2^depth, а их число растет квадратично.
+
+    Арг.:
+        qubits: регистр, к которому применяется преобразование.
+        depth: наибольшее k, для которого поворот на угол π/2^k сохраняется.
+    """
+    num_qubits = len(qubits)
+    for i in range(num_qubits // 2):
+        yield cirq.SWAP(qubits[i], qubits[-i - 1])
+    for i in reversed(range(num_qubits)):
+        yield cirq.H(qubits[i])
+        for k in range(1, min(i, depth) + 1):
+            yield cirq.CZPowGate(exponent=-1 / 2 ** k).on(qubits[i], qubits[i - k])
+
+
+@functools.lru_cache(maxsize=_CIRCUIT_CACHE_SIZE)
+def make_order_finding_circuit(x: int, n: int, approx_qft_depth: Optional[int] = None) -> cirq.Circuit:
     """Возвращает квантовую схему, для вычисления порядка x по модулю n .
 
     Схема использует оценку квантовой фазы, для вычисление собственного
@@ -74,26 +137,80 @@ def make_order_finding_circuit(x: int, n: int) -> cirq.Circuit:
        состояние суперпозиции.
     2. Реализация оператора умножения U^2^j с помощью модулярной экспоненты.
     3. Обратное квантовое преобразование Фурье для переноса собственного 
-       значения в регистр экспоненты.
+       значения в регистр экспоненты (приближенное, см. approximate_inverse_qft).
+
+    Схема кэшируется по (x, n, approx_qft_depth), поэтому возвращаемый объект не должен
+    изменяться вызывающим кодом.
 
     Арг.:
         x: положительное число, для окторого вычисляется порядок по модулю n
         n: модуль, относительно которого вычисляется порядок числа x
+        approx_qft_depth: наибольшее k для поворотов π/2^k в обратном QFT.
+            По умолчанию ceil(log2(L)) + 2.
 
     Возвращает:
         Квантовую схему для вычисления порядка x по модулю n
     """
     L = n.bit_length()
+    if approx_qft_depth is None:
+        approx_qft_depth = math.ceil(math.log2(L)) + 2
     target = cirq.LineQubit.range(L)
     exponent = cirq.LineQubit.range(L, 3 * L + 3)
+    all_qubits = (*target, *exponent)
     return cirq.Circuit(
         cirq.X(target[L - 1]),
         cirq.H.on_each(*exponent),
-        ModularExp([2] * len(target), [2] * len(exponent), x, n).on(*target + exponent),
-        cirq.qft(*exponent, inverse=True),
+        ModularExp([2] * len(target), [2] * len(exponent), x, n).on(*all_qubits),
+        approximate_inverse_qft(exponent, approx_qft_depth),
         cirq.measure(*exponent, key='exponent'),
     )
 
+
+@functools.lru_cache(maxsize=_CIRCUIT_CACHE_SIZE)
+def make_semi_classical_order_finding_circuit(x: int, n: int) -> cirq.Circuit:
+    """Возвращает квантовую схему вычисления порядка x по модулю n с полуклассическим QFT.
+
+    Схема эквивалентна make_order_finding_circuit, но регистр экспоненты из 2L+3
+    кубитов заменен одним управляющим кубитом (схема Борегара, 2n+3). Биты
+    экспоненты вычисляются по одному, начиная с младшего. Для j-го бита:
+
+    1. Управляющий кубит переводится в суперпозицию.
+    2. Выполняется умножение на x^2^(2L+2-j) mod n, управляемое этим кубитом.
+    3. Поворотами фазы, управляемыми уже измеренными битами, выполняется
+       часть обратного QFT, которая связывала бы кубиты экспоненты.
+    4. Кубит измеряется в ключ exponent_j и сбрасывается в |0⟩.
+
+    Таким образом схема использует L+1 кубит вместо 3L+3.
+
+    Арг.:
+        x: положительное число, для окторого вычисляется порядок по модулю n
+        n: модуль, относительно которого вычисляется порядок числа x
+
+    Возвращает:
+        Квантовую схему для вычисления порядка x по модулю n
+    """
+    L = n.bit_length()
+    target = cirq.LineQubit.range(L)
+    control = cirq.LineQubit(L)
+    num_bits = 2 * L + 3
+    circuit = cirq.Circuit(cirq.X(target[L - 1]))
+    for j in range(num_bits):
+        multiplier = pow(x, 1 << (num_bits - 1 - j), n)
+        circuit.append(cirq.H(control))
+        # Умножение на 1 тождественно.
+        if multiplier != 1:
+            circuit.append(ModularMul([2] * L, [1, multiplier], n).on(*target, control))
+        for k in range(j):
+            phase = cirq.Z(control) ** (-1 / 2 ** (j - k))
+            circuit.append(phase.with_classical_controls(f'exponent_{k}'))
+        circuit.append([
+            cirq.H(control),
+            cirq.measure(control, key=f'exponent_{j}'),
+            cirq.reset(control),
+        ])
+    return circuit
+
+
 def process_measurement(result: cirq.Result, x: int, n: int) -> Optional[int]:
     """Вычисление выходного значения из квантовой схемы вычисления порядка.
 
@@ -107,18 +224,24 @@ def process_measurement(result: cirq.Result, x: int, n: int) -> Optional[int]:
 
     Арг.:
         result: результат, полученный при дискретизации схемы построенной с 
-        помощью make_order_finding_circuit
+        помощью make_order_finding_circuit или make_semi_classical_order_finding_circuit
 
     Возвращает:
         r, порядок числа x по модулю n или None.
     """
     # Вычисление выходящего значения из регистра экспоненты.
-    exponent_as_integer = result.data["exponent"][0]
-    exponent_num_bits = result.measurements["exponent"].shape[1]
-    eigenphase = float(exponent_as_integer / 2 ** exponent_num_bits)
-
-    # Вычисление f = s / r.
-    f = fractions.Fraction.from_float(eigenphase).limit_denominator(n)
+    if "exponent" in result.measurements:
+        exponent_as_integer = result.data["exponent"][0]
+        exponent_num_bits = result.measurements["exponent"].shape[1]
+    else:
+        # Полуклассическая схема: бит j измерен в ключ exponent_j, начиная с младшего.
+        exponent_num_bits = len(result.measurements)
+        exponent_as_integer = sum(
+            int(result.measurements[f"exponent_{j}"][0, 0]) << j for j in range(exponent_num_bits)
+        )
+
+    # Вычисление f = s / r по точной дроби, без промежуточного float.
+    f = fractions.Fraction(int(exponent_as_integer), 1 << exponent_num_bits).limit_denominator(n)
 
     # Если нумератор = 0, результат не получен.
     if f.numerator == 0:
@@ -126,28 +249,97 @@ def process_measurement(result: cirq.Result, x: int, n: int) -> Optional[int]:
 
     # Иначе, возвращается знаменатель.
     r = f.denominator
-    if x ** r % n != 1:
+    if pow(x, r, n) != 1:
         return None
     return r
 
 
+@functools.lru_cache(maxsize=None)
 def find_factor_of_prime_power(n: int) -> Optional[int]:
     """Возвращает нетривиальный коэффициент факторизации для n, если n степень простого числа, иначе None."""
-    for k in range(2, math.floor(math.log2(n)) + 1):
-        c = math.pow(n, 1 / k)
-        c1 = math.floor(c)
-        if c1 ** k == n:
-            return c1
-        c2 = math.ceil(c)
-        if c2 ** k == n:
-            return c2
+    for k in range(2, n.bit_length()):
+        # Целочисленный корень: без потери точности float для больших n.
+        c, exact = sympy.integer_nthroot(n, k)
+        if exact:
+            return int(c)
+    return None
+
+
+def _attempt_find_factor(n: int, order_finder: Callable[[int, int], Optional[int]]) -> Optional[int]:
+    """Одна попытка найти нетривиальный коэффициент факторизации n через порядок случайного числа.
+
+    Возвращает:
+        Нетривиальный коэффициент факторизации числа n или None, если попытка неудачна.
+    """
+    # Выбираем любое число принадлежащее [2...n - 2]: для n - 1 порядок равен 2,
+    # но y = n - 1 дает только тривиальный коэффициент.
+    x = secrets.randbelow(n - 3) + 2
+
+    # Скорее всего x и n будут взаимно простыми.
+    c = math.gcd(x, n)
+
+    # Если x и n не взаимно простые, то нам повезло - мы наши
+    # нетривиальный коэффициент.
+    if 1 < c < n:
+        return c
+
+    # Если x^2 mod n == 1 и x != n - 1, то x - нетривиальный квадратный корень из 1,
+    # и gcd(x - 1, n) - нетривиальный коэффициент без вычисления порядка.
+    if pow(x, 2, n) == 1:
+        return math.gcd(x - 1, n)
+
+    # Вычисление порядка r для числа x по модулю n используя функцию вычисления порядка.
+    r = order_finder(x, n)
+
+    # Если вычисление порядка неудачно, попробуем еще раз.
+    if r is None:
+        return None
+
+    # Если порядок четный, попробуем еще раз.
+    if r % 2 != 0:
+        return None
+
+    # Вычисление нетривиального коэффициента. При y == n - 1 gcd(y - 1, n) тривиален,
+    # а y == 1 означает, что r не является порядком x, - попробуем еще раз.
+    y = pow(x, r // 2, n)
+    if y <= 1 or y >= n - 1:
+        return None
+    c = math.gcd(y - 1, n)
+    if 1 < c < n:
+        return c
     return None
 
 
+def _find_factor_in_parallel(
+        n: int,
+        order_finder: Callable[[int, int], Optional[int]],
+        max_attempts: int,
+        max_workers: int
+) -> Optional[int]:
+    """Выполняет max_attempts независимых попыток в max_workers процессах и возвращает первый найденный коэффициент."""
+    # spawn: каждый процесс заново импортирует cirq, не наследуя состояние родителя.
+    context = multiprocessing.get_context('spawn')
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers, mp_context=context)
+    try:
+        futures = [executor.submit(_attempt_find_factor, n, order_finder) for _ in range(max_attempts)]
+        for future in concurrent.futures.as_completed(futures):
+            c = future.result()
+            if c is not None:
+                return c
+        return None
+    finally:
+        # Не ждем уже запущенные попытки и отменяем еще не начатые, чтобы
+        # первый найденный коэффициент возвращался сразу.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
 def find_factor(
         n: int,
         order_finder: Callable[[int, int], Optional[int]] = quantum_order_finder,
-        max_attempts: int = 5
+        max_attempts: int = 5,
+        simulator: Optional[cirq.Sampler] = None,
+        max_workers: int = 1,
+        classical_fast_path: bool = False
 ) -> Optional[int]:
     """Возвращает нетривиальный коэффициент факторизации для составного положительного числа n.
 
@@ -155,18 +347,35 @@ def find_factor(
         n: число для факторизации.
         order_finder: Функция для нахождения порядка элементов мультипликативной группы чисел по модулю n.
         max_attempts: количество попыток для вычисления порядка с помощью order_finder.
+        simulator: симулятор для quantum_order_finder, например make_qsim_simulator(max_attempts).
+            По умолчанию используется cirq.Simulator. Поддерживается только при
+            order_finder=quantum_order_finder и max_workers == 1.
+        max_workers: количество процессов, в которых попытки выполняются параллельно.
+            При max_workers > 1 order_finder должен сериализоваться pickle.
+        classical_fast_path: для n короче QUANTUM_THRESHOLD бит вернуть наименьший простой
+            делитель из sympy.factorint, не вычисляя порядок.
 
     Возвращает:
         Нетривиальный коэффциент факторизации числа n или None, если не удалось найти  .
         Коэффициент факторизации k называют тривилальный, если k равен 1 или n.
     """
-    if order_finder == naive_order_finder:
-        print("Классический метод факторизации: ")
-    if order_finder == quantum_order_finder:
-        print("Квантовый метод факторизации: ")
+    if max_workers > 1 and simulator is not None:
+        raise ValueError('Симулятор нельзя передать в параллельные процессы, используйте max_workers=1.')
+    if simulator is not None and order_finder != quantum_order_finder:
+        raise ValueError(
+            'Симулятор используется только с order_finder=quantum_order_finder, '
+            'для другой функции передайте его через functools.partial.'
+        )
+
+    # Небольшие числа быстрее разложить классически целиком.
+    if classical_fast_path and n.bit_length() < QUANTUM_THRESHOLD:
+        factors = sympy.factorint(n)
+        if factors == {n: 1}:
+            return None
+        return min(factors)
 
     # Если число n простое, то у него нет нетривиального коэффициента.
-    if sympy.isprime(n):
+    if _is_prime(n):
         print("n простое!")
         return None
 
@@ -179,35 +388,25 @@ def find_factor(
     if c is not None:
         return c
 
-    for _ in range(max_attempts):
-        # Выбираем любое число принадлежащее [2...n - 1].
-        x = random.randint(2, n - 1)
-
-        # Скорее всего x и n будут взаимно простыми.
-        c = math.gcd(x, n)
-
-        # Если x и n не взаимно простые, то нам повезло - мы наши
-        # нетривиальный коэффициент.
-        if 1 < c < n:
-            return c
-
-        # Вычисление порядка r для числа x по модулю n используя функцию вычисления порядка.
-        r = order_finder(x, n)
-
-        # Если вычисление порядка неудачно, попробуем еще раз.
-        if r is None:
-            continue
-
-        # Если порядок четный, попробуем еще раз.
-        if r % 2 != 0:
-            continue
-
-        # Вычисление нетривиального коэффициента.
-        y = x ** (r // 2) % n
-        assert 1 < y < n
-        c = math.gcd(y - 1, n)
-        if 1 < c < n:
+    if order_finder == naive_order_finder:
+        print("Классический метод факторизации: ")
+    if order_finder == quantum_order_finder:
+        print("Квантовый метод факторизации: ")
+        # Один симулятор на все попытки.
+        if max_workers == 1:
+            if simulator is None:
+                simulator = cirq.Simulator()
+            order_finder = functools.partial(quantum_order_finder, simulator=simulator)
+
+    if max_workers > 1:
+        c = _find_factor_in_parallel(n, order_finder, max_attempts, max_workers)
+        if c is not None:
             return c
+    else:
+        for _ in range(max_attempts):
+            c = _attempt_find_factor(n, order_finder)
+            if c is not None:
+                return c
 
     print(f"Не удалось найти нетривиальный коэффициент факторизации за {max_attempts} попыток.")
     return None
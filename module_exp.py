@@ -1,6 +1,31 @@
-from typing import Sequence, Union
+from typing import List, Sequence, Union
 
 import cirq
+import numpy as np
+
+# Произведения y * d при векторном построении перестановки должны помещаться в int64.
+_MAX_MODULUS_BITS = 31
+
+
+def _modular_permutation(num_target_qubits: int, multipliers: np.ndarray, modulus: int) -> np.ndarray:
+    """Возвращает таблицу perm[y, c] = y * d[c] mod n при y < n и y иначе."""
+    targets = np.arange(1 << num_target_qubits, dtype=np.int64)[:, None]
+    return np.where(targets < modulus, targets * multipliers % modulus, targets)
+
+
+def _apply_permutation(args: cirq.ApplyUnitaryArgs, perm: np.ndarray) -> np.ndarray:
+    """Переставляет амплитуды |y⟩|c⟩ -> |perm[y, c]⟩|c⟩ без построения матрицы гейта.
+
+    Первые кубиты args.axes образуют целевой регистр y, остальные - управляющий регистр c.
+    """
+    num_targets, num_controls = perm.shape
+    axes = range(len(args.axes))
+    src = np.moveaxis(args.target_tensor, args.axes, axes).reshape(num_targets, num_controls, -1)
+    dst = np.moveaxis(args.available_buffer, args.axes, axes)
+    permuted = np.empty_like(src)
+    permuted[perm, np.arange(num_controls)] = src
+    dst[...] = permuted.reshape(dst.shape)
+    return args.available_buffer
 
 
 class ModularExp(cirq.ArithmeticGate):
@@ -24,19 +49,35 @@ class ModularExp(cirq.ArithmeticGate):
     Алгоритм квантового вычисления порядка (используется квантовое вычисление алгоритма Шора) использует
     квантовое модульное экспоненцирование вместе с квантовой оценкой фазы для вычисления порядка числа x
     по модулю n .
+
+    window_size задает количество битов экспоненты, которые при разложении объединяются в одно
+    умножение с табличным множителем.
     """
 
     def __init__(
-            self, target: Sequence[int], exponent: Union[int, Sequence[int]], base: int, modulus: int
+            self,
+            target: Sequence[int],
+            exponent: Union[int, Sequence[int]],
+            base: int,
+            modulus: int,
+            window_size: int = 1
     ) -> None:
         if len(target) < modulus.bit_length():
             raise ValueError(
                 f'Регистр с {len(target)} кубитами слишком мал для модуля {modulus}'
             )
+        if window_size < 1:
+            raise ValueError(f'Размер окна должен быть положительным, а не {window_size}')
         self.target = target
         self.exponent = exponent
         self.base = base
         self.modulus = modulus
+        self.window_size = window_size
+        # d_j = x^2^j mod n для каждого бита экспоненты.
+        num_bits = len(exponent) if isinstance(exponent, Sequence) else exponent.bit_length()
+        self._pow_table = [pow(base, 1 << j, modulus) for j in range(num_bits)]
+        # При x = 1 mod n преобразование V тождественно.
+        self._is_identity = base % modulus == 1
 
     def registers(self) -> Sequence[Union[int, Sequence[int]]]:
         return self.target, self.exponent, self.base, self.modulus
@@ -54,14 +95,63 @@ class ModularExp(cirq.ArithmeticGate):
             raise ValueError(f'Основание должно быть константным числом, а не {type(base)}')
         if not isinstance(modulus, int):
             raise ValueError(f'Модуль должен быть константным числом, а не {type(modulus)}')
-        return ModularExp(target, exponent, base, modulus)
+        return ModularExp(target, exponent, base, modulus, self.window_size)
 
     def apply(self, *register_values: int) -> int:
         assert len(register_values) == 4
         target, exponent, base, modulus = register_values
         if target >= modulus:
             return target
-        return (target * base ** exponent) % modulus
+        for j, d in enumerate(self._pow_table):
+            if exponent >> j & 1:
+                target = target * d % modulus
+        return target
+
+    def _permutation(self) -> np.ndarray:
+        """Таблица perm[y, e] = y * x^e mod n (или y при y >= n), построенная векторно."""
+        exponents = np.arange(1 << len(self.exponent), dtype=np.int64)
+        powers = np.ones(len(exponents), dtype=np.int64)
+        for j, d in enumerate(self._pow_table):
+            powers = np.where(exponents >> j & 1, powers * d % self.modulus, powers)
+        return _modular_permutation(len(self.target), powers, self.modulus)
+
+    def _apply_unitary_(self, args: cirq.ApplyUnitaryArgs) -> np.ndarray:
+        """Применяет V как разреженную перестановку амплитуд.
+
+        Таблица перестановки размером с вектор состояния строится при каждом вызове
+        и не хранится в гейте, чтобы не удерживать память, пока жива схема.
+        """
+        if self._is_identity:
+            return args.target_tensor
+        if not isinstance(self.exponent, Sequence) or self.modulus.bit_length() > _MAX_MODULUS_BITS:
+            return super()._apply_unitary_(args)
+        return _apply_permutation(args, self._permutation())
+
+    def _decompose_(self, qubits: Sequence[cirq.Qid]) -> List[cirq.Operation]:
+        """Раскладывает V на 2L/w контролируемых умножений по модулю.
+
+        Так как x^e = Π (x^2^j)^e_j, то V равно последовательности умножений на
+        классически предвычисленные константы d_j = x^2^j mod n. Биты экспоненты
+        группируются в окна по w бит: окно со значением k, начинающееся с бита j,
+        умножает целевой регистр на d_j^k mod n, взятое из таблицы на 2^w значений.
+
+        Окна с d_j = 1 тождественны и пропускаются: при x = 1 mod n разложение
+        пустое, а при x = -1 mod n остается одно умножение на младшем бите.
+        """
+        if not isinstance(self.exponent, Sequence):
+            return NotImplemented
+        target = qubits[:len(self.target)]
+        # Регистр экспоненты big-endian: последний кубит - младший бит.
+        exponent = qubits[len(self.target):][::-1]
+        operations = []
+        for j in range(0, len(exponent), self.window_size):
+            window = exponent[j:j + self.window_size]
+            d = self._pow_table[j]
+            if d == 1:
+                continue
+            multipliers = [pow(d, k, self.modulus) for k in range(1 << len(window))]
+            operations.append(ModularMul(self.target, multipliers, self.modulus).on(*target, *window[::-1]))
+        return operations
 
     def _circuit_diagram_info_(self, args: cirq.CircuitDiagramInfoArgs) -> cirq.CircuitDiagramInfo:
         assert args.known_qubits is not None
@@ -72,3 +162,102 @@ class ModularExp(cirq.ArithmeticGate):
             wire_symbols += [f'e{i}' for i in range(len(self.exponent))]
         wire_symbols[0] = f'ModularExp(t*{self.base}**{e_str} % {self.modulus})'
         return cirq.CircuitDiagramInfo(wire_symbols=tuple(wire_symbols))
+
+
+class ModularMul(cirq.ArithmeticGate):
+    """Квантовое умножение на табличную константу по модулю.
+
+        W|y⟩|c⟩ = |y * d[c] mod n⟩ |c⟩      0 <= y < n
+        W|y⟩|c⟩ = |y⟩ |c⟩                   n <= y
+
+    где y - целевой регистр, c - управляющий регистр из w кубитов, d - таблица из 2^w множителей,
+    n - модуль. Используется при разложении ModularExp: унитарное преобразование строится только
+    по L+w кубитам вместо всего регистра экспоненты.
+    """
+
+    def __init__(self, target: Sequence[int], multipliers: Sequence[int], modulus: int) -> None:
+        if len(target) < modulus.bit_length():
+            raise ValueError(
+                f'Регистр с {len(target)} кубитами слишком мал для модуля {modulus}'
+            )
+        if len(multipliers) < 2 or len(multipliers) & (len(multipliers) - 1):
+            raise ValueError(
+                f'Количество множителей должно быть степенью двойки, а не {len(multipliers)}'
+            )
+        self.target = target
+        self.multipliers = tuple(multipliers)
+        self.modulus = modulus
+
+    def registers(self) -> Sequence[Union[int, Sequence[int]]]:
+        control = [2] * (len(self.multipliers).bit_length() - 1)
+        return self.target, control, self.modulus
+
+    def with_registers(self, *new_registers: Union[int, Sequence[int]]) -> 'ModularMul':
+        if len(new_registers) != 3:
+            raise ValueError(
+                f'Ожидается 3 регистра (целевой, управляющий и модуль), '
+                f'но получено только {len(new_registers)}'
+            )
+        target, control, modulus = new_registers
+        if not isinstance(target, Sequence):
+            raise ValueError(f'Целевой должен быть регистром кубитов, а не {type(target)}')
+        num_controls = len(self.multipliers).bit_length() - 1
+        if not isinstance(control, Sequence) or len(control) != num_controls:
+            raise ValueError(
+                f'Управляющий должен быть регистром из {num_controls} кубитов '
+                f'для {len(self.multipliers)} множителей, а не {control}'
+            )
+        if not isinstance(modulus, int):
+            raise ValueError(f'Модуль должен быть константным числом, а не {type(modulus)}')
+        return ModularMul(target, self.multipliers, modulus)
+
+    def apply(self, *register_values: int) -> int:
+        assert len(register_values) == 3
+        target, control, modulus = register_values
+        if target >= modulus:
+            return target
+        return (target * self.multipliers[control]) % modulus
+
+    def _permutation(self) -> np.ndarray:
+        """Таблица perm[y, c] = y * d[c] mod n (или y при y >= n)."""
+        multipliers = np.array(self.multipliers, dtype=np.int64)
+        return _modular_permutation(len(self.target), multipliers, self.modulus)
+
+    def _apply_unitary_(self, args: cirq.ApplyUnitaryArgs) -> np.ndarray:
+        """Применяет W как разреженную перестановку амплитуд (таблица строится при каждом вызове)."""
+        if self.modulus.bit_length() > _MAX_MODULUS_BITS:
+            return super()._apply_unitary_(args)
+        return _apply_permutation(args, self._permutation())
+
+    def _decompose_(self, qubits: Sequence[cirq.Qid]) -> List[cirq.Operation]:
+        """Раскладывает умножение на 2^k по модулю 2^L - 1 в управляемые перестановки кубитов.
+
+        По такому модулю умножение на 2^k - циклический сдвиг L бит целевого регистра
+        на k позиций (y = n, все единицы, при сдвиге не меняется), поэтому его можно
+        выполнить гейтами CSWAP без построения матрицы умножителя.
+        """
+        num_qubits = len(self.target)
+        if len(self.multipliers) != 2 or self.multipliers[0] != 1 or self.modulus != (1 << num_qubits) - 1:
+            return NotImplemented
+        d = self.multipliers[1]
+        if d & (d - 1):
+            return NotImplemented
+        shift = d.bit_length() - 1
+        target, control = qubits[:num_qubits], qubits[num_qubits]
+
+        # Регистр big-endian: после сдвига влево на позиции p оказывается бит с позиции p + k.
+        positions = list(range(num_qubits))
+        operations = []
+        for p in range(num_qubits):
+            q = positions.index((p + shift) % num_qubits)
+            if q != p:
+                operations.append(cirq.CSWAP(control, target[p], target[q]))
+                positions[p], positions[q] = positions[q], positions[p]
+        return operations
+
+    def _circuit_diagram_info_(self, args: cirq.CircuitDiagramInfoArgs) -> cirq.CircuitDiagramInfo:
+        assert args.known_qubits is not None
+        num_controls = len(self.multipliers).bit_length() - 1
+        wire_symbols = [f't{i}' for i in range(len(self.target))] + [f'c{i}' for i in range(num_controls)]
+        wire_symbols[0] = f'ModularMul(t*{list(self.multipliers)}[c] % {self.modulus})'
+        return cirq.CircuitDiagramInfo(wire_symbols=tuple(wire_symbols))